@@ -21,8 +21,8 @@ import xarray as xr
 import numpy as np
 import sys
 from datetime import datetime as dt
-import pandas as pd
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 class Parent_NetCDF_File:
     '''
@@ -30,10 +30,19 @@ class Parent_NetCDF_File:
     '''
     def __init__(self, filepath):
         self.filepath = filepath
+    
+    def __enter__(self):
+        self.load_contents()
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.contents.close() # Releasing the file handle
         
     def load_contents(self):
         '''
         Loading the parent file. Checking if it exists.
+        Listing the 2D variables (those that are split into the child files) and
+        preparing the variable attributes and encoding that every child file will use.
 
         Returns
         -------
@@ -41,12 +50,72 @@ class Parent_NetCDF_File:
 
         '''
         try:
-            self.contents = xr.open_dataset(self.filepath) 
+            self.contents = xr.open_dataset(self.filepath, chunks={'POSITION': 1}, engine='h5netcdf') # One chunk per station, so each child file only reads its own profile
         except:
             print(f'''Could not load {self.filepath}.
                   Are you sure that this is the right filepath to your NetCDF file?
                   ''')
             sys.exit('File not found')
+        
+        self.subdir = self.contents.attrs['id'] # Child files are dumped in a subdirectory named after the parent file ID
+        
+        self.two_d_vars = []
+        for data_var in self.contents.data_vars:
+            if self.contents[data_var].ndim == 2:
+                self.two_d_vars.append(data_var)
+            elif self.contents[data_var].ndim > 2:
+                sys.exit(f'Not programmed to handle variables with more than 2 dimensions ({data_var})')
+        
+        for data_var in self.two_d_vars:
+            if self.contents[data_var].dims[0] != 'POSITION':
+                self.contents[data_var] = self.contents[data_var].transpose('POSITION', ...) # Putting POSITION first, so every 2D variable can be indexed [position, profile]. This is lazy and does not move any data
+        self.profile_dim = self.contents['PRES'].dims[1]
+        
+        self.data_var_set = set(self.contents.data_vars)
+        
+        self.var_attrs_template = {}
+        for data_var in self.two_d_vars:
+            attrs = dict(self.contents[data_var].attrs)
+            if 'QC' not in data_var:
+                if 'DM' not in data_var:
+                    attrs['coverage_content_type'] = 'physicalMeasurement'
+                    if 'valid_min' in attrs:
+                        attrs['valid_min'] = attrs['valid_min']*0.001 # Correcting for scale factor being automatically removed by xarray
+                    if 'valid_max' in attrs:
+                        attrs['valid_max'] = attrs['valid_max']*0.001
+            if 'ancillary_variables' in attrs:
+                attrs['ancillary_variables'] = ' '.join(av for av in attrs['ancillary_variables'].split() if av in self.data_var_set) # Dropping ancillary variables that are not in the file
+            self.var_attrs_template[data_var] = attrs
+        
+        self.dm_flag_values = {}
+        for data_var in self.two_d_vars:
+            if 'DM' in data_var and 'flag_values' in self.var_attrs_template[data_var]:
+                self.dm_flag_values[data_var] = np.array(self.var_attrs_template[data_var]['flag_values'].replace(' ','').split(','))
+        
+        self.encoding = {} # Only the 2D variables, as to_netcdf rejects encodings for variables that are not in the child file
+        for data_var in self.two_d_vars:
+            if data_var == 'PRES':
+                self.encoding[data_var] = {
+                    'dtype': 'float32',
+                    '_FillValue': None
+                    }
+            elif 'DM' in data_var:
+                self.encoding[data_var] = {
+                    'dtype': 'S1',
+                    '_FillValue': ' '
+                    }
+            elif 'QC' in data_var:
+                self.encoding[data_var] = {
+                    'dtype': 'int8',
+                    '_FillValue': -127
+                    }
+            else:
+                self.encoding[data_var] = {
+                    'dtype': 'float32',
+                    '_FillValue': -2147483647
+                    }
+            self.encoding[data_var]['zlib'] = True
+            self.encoding[data_var]['complevel'] = 4
     
     def get_coordinate_variables_values(self):
         '''
@@ -58,21 +127,43 @@ class Parent_NetCDF_File:
 
         '''
         
-        self.latitudes = np.array(self.contents['LATITUDE'])
-        self.longitudes = np.array(self.contents['LONGITUDE'])
-        self.times = np.array(self.contents['TIME'])
+        self.latitudes = self.contents['LATITUDE'].values
+        self.longitudes = self.contents['LONGITUDE'].values
+        self.times = self.contents['TIME'].values
+    
+    def get_filename_strings(self):
+        '''
+        Formatting the coordinates and times used in the names of the child files, for all stations at once
+
+        Returns
+        -------
+        None.
+
+        '''
+        self.lat_strings = np.char.replace(np.char.mod('%.4f', self.latitudes), '.', '-')
+        self.lon_strings = np.char.replace(np.char.mod('%.4f', self.longitudes), '.', '-')
+        self.isos = np.datetime_as_string(self.times, unit='s') # YYYY-MM-DDTHH:MM:SS, fractional seconds dropped
+        self.timestamp_strings = np.char.add(np.char.replace(self.isos, ':', '-'), 'Z')
+        
+        self.stems = np.char.add('Nansen_Legacy_CTD_data_single_station_lat_', self.lat_strings)
+        self.stems = np.char.add(np.char.add(self.stems, '_lon_'), self.lon_strings)
+        self.stems = np.char.add(np.char.add(self.stems, '_dt_'), self.timestamp_strings)
     
     def get_min_max_pressures(self):
         '''
-        Getting a list of the minimum and maximum depths for each station
+        Getting a list of the minimum and maximum depths for each station,
+        and the indices at which they occur
         
         Returns
         -------
         None.
 
         '''     
-        self.min_pressures = [min(i) for i in np.array(self.contents['PRES'])]
-        self.max_pressures = [max(i) for i in np.array(self.contents['PRES'])]
+        self.pressures = self.contents['PRES'].values
+        self.min_pressures = np.nanmin(self.pressures, axis=1)
+        self.max_pressures = np.nanmax(self.pressures, axis=1)
+        self.i_min = np.nanargmin(self.pressures, axis=1)
+        self.i_max = np.nanargmax(self.pressures, axis=1)
     
     def add_change_drop_gloabl_attributes(self):
         '''
@@ -166,16 +257,18 @@ class Child_NetCDF_File:
         
         self.latitude = self.parentFile.latitudes[self.position]
         self.longitude = self.parentFile.longitudes[self.position]
-        self.lat_string = "{:.4f}".format(self.latitude).replace('.','-')
-        self.lon_string = "{:.4f}".format(self.longitude).replace('.','-')
+        self.lat_string = str(self.parentFile.lat_strings[self.position])
+        self.lon_string = str(self.parentFile.lon_strings[self.position])
         
         self.min_pressure = self.parentFile.min_pressures[self.position]
         self.max_pressure = self.parentFile.max_pressures[self.position]
         
         self.time = self.parentFile.times[self.position]
-        self.timestamp_string = np.datetime_as_string(self.time, timezone='UTC').split('.')[0].replace(':','-') + 'Z'
+        self.iso = str(self.parentFile.isos[self.position])
+        self.timestamp_string = str(self.parentFile.timestamp_strings[self.position])
         
-        self.filename = f'Nansen_Legacy_CTD_data_single_station_lat_{self.lat_string}_lon_{self.lon_string}_dt_{self.timestamp_string}.nc'
+        self.stem = str(self.parentFile.stems[self.position])
+        self.filename = self.stem + '.nc'
         
     def create_dataset_with_variables(self):  
         '''
@@ -188,55 +281,25 @@ class Child_NetCDF_File:
         None.
 
         '''
-        pressures = np.array(self.parentFile.contents['PRES'][self.position])
-        i_min = list(pressures).index(self.min_pressure)
-        i_max = list(pressures).index(self.max_pressure)
+        i_min = self.parentFile.i_min[self.position]
+        i_max = self.parentFile.i_max[self.position]
         
-        df = pd.DataFrame()
+        data_vars = {}
         
-        for data_var in list(self.parentFile.contents.data_vars):
-            if len(self.parentFile.contents[data_var].dims) == 2:
-                values = np.array(self.parentFile.contents[data_var][self.position])
-                values = values[i_min:i_max]
-                df[data_var] = values
-            elif len(self.parentFile.contents[data_var].dims) > 2:
-                sys.exit(f'Not programmed to handle variables with more than 2 dimensions ({data_var})')
-            else:
-                pass
-            
-        self.contents = xr.Dataset.from_dataframe(df)
-                
-        self.contents = self.contents.set_coords('PRES') # Specfiy pressure as a coordinate (to be used as a dimension)
-                
-        self.contents = self.contents.reset_index('index', drop=True) # Get rid of the numeric index as dimension.
+        profile = self.parentFile.contents[self.parentFile.two_d_vars].isel({
+            'POSITION': self.position,
+            self.parentFile.profile_dim: slice(i_min, i_max) # Only read the part of the profile that is needed
+            }).compute() # All variables for this station are read in one go
         
-        self.contents = self.contents.swap_dims({'index':'PRES'})
+        for data_var in self.parentFile.two_d_vars:
+            data_vars[data_var] = (('PRES',), profile[data_var].values)
         
-        for data_var in list(self.parentFile.contents.data_vars):
-            if len(self.parentFile.contents[data_var].dims) == 2:
-                self.contents[data_var].attrs = self.parentFile.contents[data_var].attrs
-                if 'QC' not in data_var:
-                    if 'DM' not in data_var:
-                        self.contents[data_var].attrs['coverage_content_type'] = 'physicalMeasurement'
-                        if 'valid_min' in list(self.parentFile.contents[data_var].attrs.keys()):
-                            self.contents[data_var].attrs['valid_min'] = self.parentFile.contents[data_var].attrs['valid_min']*0.001 # Correcting for scale factor being automatically removed by xarray
-                        if 'valid_max' in list(self.parentFile.contents[data_var].attrs.keys()):
-                            self.contents[data_var].attrs['valid_max'] = self.parentFile.contents[data_var].attrs['valid_max']*0.001     
-            elif len(self.parentFile.contents[data_var].dims) > 2:
-                sys.exit(f'Not programmed to handle variables with more than 2 dimensions ({data_var})')
-            else:
-                pass
-                
-            
-            try:
-                avs = self.parentFile.contents[data_var].attrs['ancillary_variables'].split(' ')
-                for av in avs:
-                    if av not in list(self.parentFile.contents.data_vars):
-                        self.contents[data_var].attrs['ancillary_variables'] = self.contents[data_var].attrs['ancillary_variables'].replace(av,'')
-                    else:
-                        pass
-            except:
-                continue
+        pres_slice = data_vars.pop('PRES')[1]
+        
+        self.contents = xr.Dataset(data_vars=data_vars, coords={'PRES': pres_slice}) # Pressure is the coordinate (and dimension) of each child file
+        
+        for data_var in self.parentFile.two_d_vars:
+            self.contents[data_var].attrs = self.parentFile.var_attrs_template[data_var] # xarray copies the dict, so the template is not modified
             
     def assign_global_attributes(self):
         '''
@@ -248,34 +311,35 @@ class Child_NetCDF_File:
         None.
 
         '''
-        self.contents.attrs = self.parentFile.contents.attrs.copy()
-        
-        self.contents.attrs['geospatial_lat_min'] = self.latitude
-        self.contents.attrs['geospatial_lat_max'] = self.latitude
-        self.contents.attrs['geospatial_lon_min'] = self.longitude
-        self.contents.attrs['geospatial_lon_max'] = self.longitude
-        self.contents.attrs['geospatial_vertical_min'] = self.min_pressure
-        self.contents.attrs['geospatial_vertical_max'] = self.max_pressure
-        self.contents.attrs['geospatial_vertical_units'] = 'dbar'
-        self.contents.attrs['geospatial_vertical_resolution'] = '1 dbar'
-        
-        self.contents.attrs['time_coverage_start'] = str(self.time).split('.')[0]+'Z'
-        self.contents.attrs['time_coverage_end'] = str(self.time).split('.')[0]+'Z'
-        
+        parent_attrs = self.parentFile.contents.attrs
         dtnow = dt.now().strftime("%Y-%m-%dT%H:%M:%SZ")
-        self.contents.attrs['date_created'] = dtnow
-        self.contents.attrs['date_update'] = dtnow
-        self.contents.attrs['history'] = f'Created at {dtnow} using the xarray library in Python'
         
-        self.contents.attrs['id'] = self.contents.attrs['id']+'_'+self.lat_string+'_'+self.lon_string
-        self.contents.attrs['title'] = self.filename.split('.')[0]
-        del self.contents.attrs['doi']
+        new_attrs = {
+            **parent_attrs,
+            'geospatial_lat_min': self.latitude,
+            'geospatial_lat_max': self.latitude,
+            'geospatial_lon_min': self.longitude,
+            'geospatial_lon_max': self.longitude,
+            'geospatial_vertical_min': self.min_pressure,
+            'geospatial_vertical_max': self.max_pressure,
+            'geospatial_vertical_units': 'dbar',
+            'geospatial_vertical_resolution': '1 dbar',
+            'time_coverage_start': self.iso+'Z',
+            'time_coverage_end': self.iso+'Z',
+            'date_created': dtnow,
+            'date_update': dtnow,
+            'history': f'Created at {dtnow} using the xarray library in Python',
+            'id': parent_attrs['id']+'_'+self.lat_string+'_'+self.lon_string,
+            'title': self.stem,
+            'comment': 'Descending CTD profile'
+            }
+        new_attrs.pop('doi', None)
         
-        self.contents.attrs['comment'] = 'Descending CTD profile'
+        self.contents.attrs = new_attrs
 
     def output_to_netcdf(self):
         '''
-        Defining the encoding for each variable and outputting as a NetCDF file
+        Outputting as a NetCDF file, using the encoding defined for each variable in the parent file
         Each file is dumped in a subdirectory with the name from the ID of the parent file
 
         Returns
@@ -283,62 +347,75 @@ class Child_NetCDF_File:
         None.
 
         '''
-        self.encoding = {}
+        for data_var, flag_values in self.parentFile.dm_flag_values.items():
+            self.contents[data_var].attrs['flag_values'] = flag_values
         
-        for data_var in list(self.contents.data_vars):
-            
-            if data_var == 'PRES':
-                self.encoding[data_var] = {
-                    'dtype': 'float32',
-                    '_FillValue': None
-                    }
-            elif 'DM' in data_var:
-                self.contents[data_var].attrs['flag_values'] = np.array(self.contents[data_var].attrs['flag_values'].replace(' ','').split(','))
-                self.encoding[data_var] = {
-                    'dtype': 'S1',
-                    '_FillValue': ' '
-                    }
-            elif 'QC' in data_var:
-                self.encoding[data_var] = {
-                    'dtype': 'int8',
-                    '_FillValue': -127
-                    }
-            else:
-                self.encoding[data_var] = {
-                    'dtype': 'float32',
-                    '_FillValue': -2147483647
-                    }
+        encoding = self.parentFile.encoding # Shared by all child files, to_netcdf does not modify it
         
-        subdir = self.parentFile.contents.attrs['id']
-        if not os.path.exists(subdir):
-            os.makedirs(subdir)
-        self.contents.to_netcdf(subdir+'/'+self.filename,encoding=self.encoding)       
+        self.contents.to_netcdf(os.path.join(self.parentFile.subdir, self.filename),encoding=encoding,engine='netcdf4')       
+
+def load_parent_file(filepath):
+    '''
+    Loading the parent file and preparing everything the child files need from it
+
+    Returns
+    -------
+    parentFile : Parent_NetCDF_File
+
+    '''
+    parentFile = Parent_NetCDF_File(filepath)
+    parentFile.load_contents()
+    parentFile.add_change_drop_gloabl_attributes()
+    parentFile.get_coordinate_variables_values()
+    parentFile.get_filename_strings()
+    parentFile.get_min_max_pressures()
+    return parentFile
+
+worker_parentFile = None # Parent file loaded once in each worker process
+
+def init_worker(filepath):
+    '''
+    Loading the parent file in a worker process, so that it is not reloaded for every station.
+    The file stays open until the worker process exits at the end of each parent file.
+
+    Returns
+    -------
+    None.
+
+    '''
+    global worker_parentFile
+    worker_parentFile = load_parent_file(filepath)
+
+def process_station(position):
+    '''
+    Creating and outputting the child file for a single station.
+    Run in a worker process that has been initialised with init_worker.
+
+    Returns
+    -------
+    filename : str
+
+    '''
+    childFile = Child_NetCDF_File(position, worker_parentFile)
+    childFile.create_dataset_with_variables()
+    childFile.assign_global_attributes()
+    childFile.output_to_netcdf()
+    return childFile.filename
 
 def main():
     parent_files = os.listdir('data/')
     for parent_file in parent_files:
         print('\nParent file:',parent_file)
-        parentFile = Parent_NetCDF_File('data/'+parent_file)
-        parentFile.load_contents()
-        parentFile.add_change_drop_gloabl_attributes()
-        parentFile.get_coordinate_variables_values()
-        parentFile.get_min_max_pressures()
+        filepath = 'data/'+parent_file
+        with Parent_NetCDF_File(filepath) as parentFile:
+            positions = parentFile.contents['POSITION'].values
+            subdir = parentFile.subdir
+        os.makedirs(subdir, exist_ok=True)
         
-        for p in np.array(parentFile.contents['POSITION']):
-            print("Position:", p)
-            childFile = Child_NetCDF_File(p, parentFile)
-            childFile.create_dataset_with_variables()
-            childFile.assign_global_attributes()
-            childFile.output_to_netcdf()
-            print('File created: ', childFile.filename,'\n')
+        with ProcessPoolExecutor(initializer=init_worker, initargs=(filepath,)) as executor:
+            for p, filename in zip(positions, executor.map(process_station, positions)):
+                print("Position:", p)
+                print('File created: ', filename,'\n')
             
 if __name__ == "__main__":
     sys.exit(main())
-        
-#%%
-
-file = xr.open_dataset('AR_PR_CT_58GS_2020113/Nansen_Legacy_CTD_data_single_station_lat_78-3517_lon_34-7638_dt_2020-10-20T07-35-31Z.nc')
-print(file['PRES_DM'])
-
-#%%
-file.close()
\ No newline at end of file